@@ -1,12 +1,80 @@
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import os
+
 import numpy as np
-import random
 
+try:
+    from numba import njit, prange
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
+# number of rows of X processed at a time when assigning points to centers
+_BLOCK_ROWS = 4096
+# largest n * k * d for which distances are computed by broadcasting
+_BROADCAST_MAX_SIZE = 10**6
+# below this many features the compiled kernel beats the matrix product
+_NUMBA_MAX_DIM = 16
+# largest (n, k) distance bound matrix kept for Elkan's algorithm
+_ELKAN_MAX_BOUNDS = 2**27
+# largest (block, k) distance matrix or (block, d) copy of X held on the GPU
+_CUPY_BLOCK_SIZE = 2**26
+
+
+def _float_dtype(dtype):
+    """
+    Returns `dtype` if it is a floating point type, float64 otherwise.
+    """
+    if np.issubdtype(dtype, np.floating):
+        return dtype
+    return np.dtype(np.float64)
+
+
+def _check_data(X):
+    """
+    Validates data passed to `fit` or `fit_assign` and returns it centered,
+    as a C-contiguous float32 array, along with its float64 column means.
 
-def init_centers(X, k):
+    Distances are computed from squared norms, which lose precision to
+    cancellation when the data is far from the origin. The mean is removed
+    in double precision before the cast, so that the identity works on
+    small values and only the usual float32 rounding remains.
+    """
+    X = np.asarray(X)
+    # Throw error if X is not a 2-d array
+    if X.ndim != 2:
+        raise Exception("Data must be a 2-d array")
+    # convert anything that is not already numeric, e.g. lists with None
+    if X.dtype.kind not in "biuf":
+        X = X.astype(np.float64)
+    # Throw error if X contains missing values, integer data cannot
+    if X.dtype.kind == "f" and not np.isfinite(X).all():
+        raise Exception("Array contains non-numeric data")
+
+    # no data has no mean, `fit` reports that there are too few points
+    X_mean = X.mean(axis=0, dtype=np.float64) if len(X) \
+        else np.zeros(X.shape[1])
+    # center one block of rows at a time to bound the float64 temporaries
+    X_centered = np.empty(X.shape, dtype=np.float32)
+    for start in range(0, X.shape[0], _BLOCK_ROWS):
+        block = X[start:start + _BLOCK_ROWS] - X_mean
+        # Throw error if X cannot be represented in single precision
+        if block.size and np.abs(block).max() > np.finfo(np.float32).max:
+            raise Exception("Data values are too large, the maximum spread "
+                            f"is {np.finfo(np.float32).max:.3g}")
+        X_centered[start:start + _BLOCK_ROWS] = block
+    return X_centered, X_mean
+
+
+def init_centers(X, k, seed=None, X_sq=None):
     """
     This function chooses initial cluster locations using Kmeans++
 
+    At each step a few candidate points are sampled and the one that most
+    reduces the sum of squared distances to the nearest center is kept
+    ("greedy" Kmeans++), which gives better starting centers than a
+    single sample.
+
     Parameters
     ----------
     X : array
@@ -15,6 +83,12 @@ def init_centers(X, k):
     k : int
     The desired number of clusters .
 
+    seed : int or numpy.random.Generator, optional
+    Seed or random number generator used to pick the centers.
+
+    X_sq : array, optional
+    Precomputed squared norms of the rows of `X`. Dimensions: (n,)
+
     Returns
     -------
     array
@@ -37,36 +111,52 @@ def init_centers(X, k):
 
     n = X.shape[0]
     dimensions = X.shape[1]
-    centers = np.zeros((k, dimensions))
-    ind = []  # indeces of existing centers
+    centers = np.zeros((k, dimensions), dtype=_float_dtype(X.dtype))
+    rng = np.random.default_rng(seed)
+    if X_sq is None:
+        X_sq = np.einsum('ij,ij->i', X, X)
+    # number of candidates sampled for each center
+    n_candidates = 2 + int(np.log(k))
 
     # pick 1st center at random
-    ind.append(random.randint(0, n - 1))
-    centers[0, ] = X[ind[0]]
+    ind = rng.integers(n)
+    centers[0, ] = X[ind]
+    # squared distance from every point to its nearest existing center
+    min_sq = measure_dist_sq(X, X[ind:ind + 1], X_sq, X_sq[ind:ind + 1])
+    min_sq = min_sq[:, 0].astype(np.float64)
+    min_sq[ind] = 0
+    chosen = np.zeros(n, dtype=bool)
+    chosen[ind] = True
+    # scratch space for the running minimum if a candidate were chosen
+    new_sq = np.empty(n)
+    best_sq = np.empty(n)
 
     # find rest of centers
     for kk in range(1, k):
-        # measure distance from every point to current center
-        dists_sq = measure_dist(X, centers[0:kk])**2
-        # set distance between existing centers to 0
-        for i in ind:
-            dists_sq[i] = np.zeros((1, dists_sq.shape[1]))
-        # replace 0 with inf so they don't get selected
-        dists_sq[dists_sq == 0] = np.inf
-        # select minimum distance in row
-        dists_sq = dists_sq.min(axis=1)
-        # replace inf with 0 again to make probability of selecting existing
-        # center zero
-        dists_sq[dists_sq == np.inf] = 0
-        # probability prop to dist_sq
-        probs = (dists_sq / np.sum(dists_sq)).tolist()
-        ind.append(
-            np.random.choice(
-                range(
-                    len(probs)),
-                size=1,
-                p=probs))  # select point at random
-        centers[kk, ] = X[ind[-1]]
+        total = min_sq.sum()
+        if total == 0:
+            # every point sits on a center, e.g. there are fewer distinct
+            # points than clusters, so pick any point not chosen yet
+            ind = rng.choice(np.flatnonzero(~chosen))
+        else:
+            # sample candidates with probability prop to dist_sq
+            candidates = rng.choice(n, size=n_candidates, p=min_sq / total)
+            # keep the candidate that leaves points closest to their centers
+            best_potential = np.inf
+            for cand in candidates:
+                cand_sq = measure_dist_sq(X, X[cand:cand + 1], X_sq,
+                                          X_sq[cand:cand + 1])
+                np.minimum(min_sq, cand_sq[:, 0], out=new_sq)
+                potential = new_sq.sum()
+                if potential < best_potential:
+                    best_potential = potential
+                    ind = cand
+                    new_sq, best_sq = best_sq, new_sq
+            min_sq, best_sq = best_sq, min_sq
+        # make probability of selecting an existing center zero
+        min_sq[ind] = 0
+        chosen[ind] = True
+        centers[kk, ] = X[ind]
     return centers
 
 
@@ -103,15 +193,16 @@ def assign(X, centers):
     if X.shape[0] < centers.shape[0]:
         raise Exception("There are more centers than data points")
 
-    n = X.shape[0]
-    labels = np.zeros(n, dtype=int)
-    distances = measure_dist(X, centers)
-    for nn in range(n):
-        labels[nn] = np.argmin(distances[nn])
+    # distances are computed from squared norms, which lose precision to
+    # cancellation far from the origin, so move the centers around it
+    dtype = np.result_type(_float_dtype(X.dtype), _float_dtype(centers.dtype))
+    C_mean = centers.mean(axis=0, dtype=np.float64)
+    labels, _ = _assign_fused((X - C_mean).astype(dtype, copy=False),
+                              (centers - C_mean).astype(dtype, copy=False))
     return labels
 
 
-def measure_dist(X, centers):
+def measure_dist(X, centers, X_sq=None, C_sq=None):
     """
     Measures the euclidean distance between each row (point) in `X`,
     and each row (cluster centre) in `centers`
@@ -124,6 +215,12 @@ def measure_dist(X, centers):
     centers : array
     The locations of the cluster centers. Dimensions: (k,d)
 
+    X_sq : array, optional
+    Precomputed squared norms of the rows of `X`. Dimensions: (n,)
+
+    C_sq : array, optional
+    Precomputed squared norms of the rows of `centers`. Dimensions: (k,)
+
     Returns
     -------
     array
@@ -134,25 +231,253 @@ def measure_dist(X, centers):
     >>> from sklearn.datasets import make_blobs
     >>> X, _ = make_blobs(n_samples=10, centers=3, n_features=2)
     >>> centers = fit(X, 3)
-    >>> distances = predict(X, centers)
+    >>> distances = measure_dist(X, centers)
+    """
+    return np.sqrt(measure_dist_sq(X, centers, X_sq, C_sq))
+
+
+def measure_dist_sq(X, centers, X_sq=None, C_sq=None):
+    """
+    Measures the squared euclidean distance between each row (point) in `X`,
+    and each row (cluster centre) in `centers`.
+
+    Small inputs are handled by broadcasting the differences. Larger inputs,
+    where the (n, k, d) temporary would be expensive, use the identity
+    ||x - c||^2 = ||x||^2 + ||c||^2 - 2 x.c so that the bulk of the work is
+    a single matrix product.
+
+    Parameters
+    ----------
+    X : array
+    Data for cluster assignment. Dimensions: (n,d)
+
+    centers : array
+    The locations of the cluster centers. Dimensions: (k,d)
+
+    X_sq : array, optional
+    Precomputed squared norms of the rows of `X`. Dimensions: (n,)
+
+    C_sq : array, optional
+    Precomputed squared norms of the rows of `centers`. Dimensions: (k,)
+
+    Returns
+    -------
+    array
+    The squared distances from each point to each center. Dimensions: (n, k)
+
+    Examples
+    --------
+    >>> from sklearn.datasets import make_blobs
+    >>> X, _ = make_blobs(n_samples=10, centers=3, n_features=2)
+    >>> centers = fit(X, 3)
+    >>> distances_sq = measure_dist_sq(X, centers)
     """
 
     # Throw error if there are more centers than data points
     if X.shape[0] < centers.shape[0]:
         raise Exception("There are more centers than data points")
 
-    n = X.shape[0]
-    k = centers.shape[0]
-    distances = np.zeros((n, k))
-    for kk in range(k):
-        for nn in range(n):
-            pt = X[nn, ]
-            cent = centers[kk, ]
-            distances[nn, kk] = np.sqrt(np.sum((pt - cent)**2))
-    return distances
+    if X.shape[0] * centers.shape[0] * X.shape[1] < _BROADCAST_MAX_SIZE:
+        return ((X[:, None, :] - centers[None, :, :])**2).sum(axis=2)
+
+    if X_sq is None:
+        X_sq = np.einsum('ij,ij->i', X, X)
+    if C_sq is None:
+        C_sq = np.einsum('ij,ij->i', centers, centers)
+    D2 = X_sq[:, None] + C_sq[None, :] - 2.0 * (X @ centers.T)
+    # rounding can push distances of coincident points slightly below zero
+    np.maximum(D2, 0, out=D2)
+    return D2
+
+
+def _assign_fused(X, centers, X_sq=None, centers_T=None, C_sq=None,
+                  parallel=True):
+    """
+    Finds the nearest center and the squared distance to it for every point
+    in `X` without materializing the full (n, k) distance matrix.
+
+    Rows of `X` are processed in blocks of `_BLOCK_ROWS`, reusing a single
+    (block, k) buffer, so only O(n) output is written. When numba is
+    installed and `X` has few features a compiled kernel is used instead.
+
+    Parameters
+    ----------
+    X : array
+    Data for cluster assignment. Dimensions: (n,d)
 
+    centers : array
+    The locations of the cluster centers. Dimensions: (k,d)
+
+    X_sq : array, optional
+    Precomputed squared norms of the rows of `X`. Dimensions: (n,)
+
+    centers_T : array, optional
+    A contiguous copy of `centers.T`, so callers iterating over changing
+    centers can reuse one buffer. Dimensions: (d,k)
+
+    C_sq : array, optional
+    Precomputed squared norms of the rows of `centers`. Dimensions: (k,)
+
+    parallel : bool, optional
+    Whether the compiled kernel may use multiple threads. Default is True.
+
+    Returns
+    -------
+    array
+    The index of the nearest center for each point. Dimensions: (n,)
 
-def calc_centers(X, centers, labels):
+    array
+    The squared distance to the nearest center. Dimensions: (n,)
+    """
+    n = X.shape[0]
+    k = centers.shape[0]
+    if centers_T is None:
+        centers_T = centers.T
+    dtype = np.result_type(X.dtype, centers_T.dtype, np.float32)
+    labels = np.empty(n, dtype=np.intp)
+    mindist = np.empty(n, dtype=dtype)
+
+    if _HAS_NUMBA and X.shape[1] < _NUMBA_MAX_DIM:
+        kernel = _assign_numba if parallel else _assign_numba_serial
+        kernel(np.ascontiguousarray(X, dtype=dtype),
+               np.ascontiguousarray(centers, dtype=dtype),
+               labels, mindist)
+        return labels, mindist
+
+    if X_sq is None:
+        X_sq = np.einsum('ij,ij->i', X, X)
+    if C_sq is None:
+        C_sq = np.einsum('ij,ij->j', centers_T, centers_T)
+
+    buf = np.empty((min(n, _BLOCK_ROWS), k), dtype=dtype)
+
+    for start in range(0, n, _BLOCK_ROWS):
+        stop = min(start + _BLOCK_ROWS, n)
+        D2 = buf[:stop - start]
+        np.matmul(X[start:stop], centers_T, out=D2)
+        D2 *= -2.0
+        D2 += X_sq[start:stop, None]
+        D2 += C_sq[None, :]
+        labels[start:stop] = D2.argmin(axis=1)
+        mindist[start:stop] = D2.min(axis=1)
+
+    # rounding can push distances of coincident points slightly below zero
+    np.maximum(mindist, 0, out=mindist)
+    return labels, mindist
+
+
+if _HAS_NUMBA:
+    def _assign_kernel(X, centers, labels, mindist):
+        """
+        Compiled, multi-threaded equivalent of `_assign_fused` that computes
+        distances directly. Writes the results into `labels` and `mindist`.
+        """
+        n, d = X.shape
+        k = centers.shape[0]
+        for i in prange(n):
+            # start from the first center rather than infinity, since
+            # fastmath assumes no infinite values
+            best = 0
+            best_dist = 0.0
+            for t in range(d):
+                diff = X[i, t] - centers[0, t]
+                best_dist += diff * diff
+            for j in range(1, k):
+                dist = 0.0
+                for t in range(d):
+                    diff = X[i, t] - centers[j, t]
+                    dist += diff * diff
+                if dist < best_dist:
+                    best_dist = dist
+                    best = j
+            labels[i] = best
+            mindist[i] = best_dist
+
+    @njit(fastmath=True, cache=True)
+    def _dist_numba(X, i, centers, j):
+        """
+        Euclidean distance between row `i` of `X` and row `j` of `centers`.
+        """
+        dist = 0.0
+        for t in range(X.shape[1]):
+            diff = X[i, t] - centers[j, t]
+            dist += diff * diff
+        return np.sqrt(dist)
+
+    def _elkan_init_kernel(X, centers, labels, upper, lower):
+        """
+        Assigns every point to its nearest center, filling the bounds used
+        by `_elkan_kernel` with exact distances.
+        """
+        n = X.shape[0]
+        k = centers.shape[0]
+        for i in prange(n):
+            best = 0
+            best_dist = _dist_numba(X, i, centers, 0)
+            lower[i, 0] = best_dist
+            for j in range(1, k):
+                dist = _dist_numba(X, i, centers, j)
+                lower[i, j] = dist
+                if dist < best_dist:
+                    best_dist = dist
+                    best = j
+            labels[i] = best
+            upper[i] = best_dist
+
+    def _elkan_kernel(X, centers, half_dist, s, labels, upper, lower):
+        """
+        Reassigns points to their nearest center using Elkan's triangle
+        inequality bounds to skip distances that cannot change the result.
+
+        `half_dist` holds half the distance between each pair of centers and
+        `s` half the distance from each center to its nearest other center.
+        `upper` bounds each point's distance to its assigned center and
+        `lower` bounds its distance to every center; all are updated in
+        place along with `labels`.
+        """
+        n = X.shape[0]
+        k = centers.shape[0]
+        for i in prange(n):
+            a = labels[i]
+            u = upper[i]
+            # no other center can be closer if the point is within half
+            # the distance to the nearest other center
+            if u > s[a]:
+                tight = False
+                for j in range(k):
+                    if j == a or u <= lower[i, j] or u <= half_dist[a, j]:
+                        continue
+                    # tighten the upper bound before comparing
+                    if not tight:
+                        u = _dist_numba(X, i, centers, a)
+                        lower[i, a] = u
+                        tight = True
+                        if u <= lower[i, j] or u <= half_dist[a, j]:
+                            continue
+                    dist = _dist_numba(X, i, centers, j)
+                    lower[i, j] = dist
+                    if dist < u:
+                        a = j
+                        u = dist
+                labels[i] = a
+                upper[i] = u
+
+    # Each kernel is compiled twice, both releasing the GIL: a multi-threaded
+    # version for a single run, and a serial version for when several runs
+    # are spread over threads, since numba's default threading layer cannot
+    # launch parallel kernels from more than one thread at a time. Only the
+    # multi-threaded versions are cached, as both share a cache entry.
+    _parallel = njit(nogil=True, parallel=True, fastmath=True, cache=True)
+    _serial = njit(nogil=True, fastmath=True)
+    _assign_numba = _parallel(_assign_kernel)
+    _assign_numba_serial = _serial(_assign_kernel)
+    _elkan_init_numba = _parallel(_elkan_init_kernel)
+    _elkan_init_numba_serial = _serial(_elkan_init_kernel)
+    _elkan_numba = _parallel(_elkan_kernel)
+    _elkan_numba_serial = _serial(_elkan_kernel)
+
+
+def calc_centers(X, centers, labels, mindist=None):
     """
     Calculates the coordinates of the centroid of each cluster
 
@@ -163,15 +488,21 @@ def calc_centers(X, centers, labels):
 
     centers : array
     The locations of the cluster centers. Dimensions: (k,d).
-    Used only to determine number of clusters
+    Used to determine number of clusters, and to find the points farthest
+    from any center when a cluster is empty
 
     labels: array
     The assigned cluster for each data point in X. Dimensions: (n,)
 
+    mindist: array, optional
+    The squared distance from each point in X to its nearest center, if
+    already known. Only used when a cluster is empty. Dimensions: (n,)
+
     Returns
     -------
     array
-    A (k,d) array of the center locations for each cluster.
+    A (k,d) array of the center locations for each cluster. Has the same
+    dtype as `X` if `X` is floating point, float64 otherwise.
 
     """
     #  Throw error if `X` and `labels` have different lengths
@@ -185,24 +516,117 @@ def calc_centers(X, centers, labels):
     d = X.shape[1]
     k = centers.shape[0]
 
-    new_centers = np.zeros((k, d))
-    for kk in range(k):
-        # mean of points assigned to center kk for each dimension
-        current_center = [np.mean(X[labels == kk][:, dd]) for dd in range(d)]
-        # If there are points assigned to current center
-        if not np.isnan(np.sum(current_center)):
-            # add current center to new_centers
-            new_centers[kk] = current_center
-        # if there is points assigned to nearest center
-        else:
-            dists = measure_dist(X, centers[kk])
-            # set new center to farthest point from current center
-            new_centers[kk] = X[np.argmax(dists) // d, ]
+    labels = np.asarray(labels, dtype=np.intp)
+    # Throw error if a label does not refer to one of the centers
+    if len(labels) and (labels.min() < 0 or labels.max() >= k):
+        raise Exception("Labels must be between 0 and the number of "
+                        "centers minus one")
+    # sum and count the points assigned to each center in a single pass,
+    # accumulating in double precision to avoid drift on large clusters
+    counts = np.bincount(labels, minlength=k)
+    sums = np.zeros((k, d), dtype=np.float64)
+    _add_sums(sums, X, labels)
+
+    return _centers_from_sums(X, centers, sums, counts, mindist)
+
+
+def _add_sums(sums, X, labels):
+    """
+    Adds the rows of `X` to the rows of `sums` given by `labels`, one column
+    at a time with `np.bincount`, which is much faster than `np.add.at`.
+    """
+    k = sums.shape[0]
+    for j in range(X.shape[1]):
+        sums[:, j] += np.bincount(labels, weights=X[:, j], minlength=k)
+
+
+def _centers_from_sums(X, centers, sums, counts, mindist=None):
+    """
+    Turns per-cluster coordinate sums and point counts into cluster means,
+    moving any center with no points to the point farthest from all centers.
+    `mindist` holds each point's squared distance to its nearest center and
+    is computed here only if a cluster is empty and it is not given.
+    """
+    k, d = centers.shape
+    new_centers = np.zeros((k, d), dtype=_float_dtype(X.dtype))
+    nonempty = counts > 0
+    new_centers[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+    empty = np.flatnonzero(~nonempty)
+    if len(empty) == 0:
+        return new_centers
+    if mindist is None:
+        _, mindist = _assign_fused(X, centers)
+    else:
+        mindist = mindist.copy()
+    # if no points are assigned to a center
+    for kk in empty:
+        # set new center to farthest point from any current center
+        farthest = np.argmax(mindist)
+        new_centers[kk] = X[farthest, ]
+        # so that the next empty center picks a different point
+        mindist[farthest] = 0
 
     return new_centers
 
 
-def fit(X, k):
+def _iter(X, centers, X_sq, centers_T, C_sq, parallel=True):
+    """
+    Runs one k-means iteration in a single streaming pass over `X`.
+
+    Each block of rows is assigned to its nearest centers and immediately
+    added to the per-cluster sums while it is still in cache, instead of
+    assigning all of `X` and then reading it again to compute the means.
+
+    Parameters
+    ----------
+    X : array
+    Data to train clustering model with. Dimensions: (n,d)
+
+    centers : array
+    The current locations of the cluster centers. Dimensions: (k,d)
+
+    X_sq : array
+    Squared norms of the rows of `X`. Dimensions: (n,)
+
+    centers_T : array
+    A contiguous copy of `centers.T`. Dimensions: (d,k)
+
+    C_sq : array
+    Squared norms of the rows of `centers`. Dimensions: (k,)
+
+    parallel : bool, optional
+    Whether compiled kernels may use multiple threads. Default is True.
+
+    Returns
+    -------
+    array
+    The updated locations of the cluster centers. Dimensions: (k,d)
+    """
+    n, d = X.shape
+    k = centers.shape[0]
+    # blocks large enough that the per-block overhead stays small
+    block = _BLOCK_ROWS
+
+    sums = np.zeros((k, d), dtype=np.float64)
+    counts = np.zeros(k, dtype=np.intp)
+    # kept to move the centers of empty clusters, see `_centers_from_sums`
+    mindist = np.empty(n, dtype=np.result_type(X.dtype, np.float32))
+
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        Xb = X[start:stop]
+        labels_b, mindist_b = _assign_fused(
+            Xb, centers, X_sq[start:stop], centers_T, C_sq, parallel)
+        _add_sums(sums, Xb, labels_b)
+        counts += np.bincount(labels_b, minlength=k)
+        mindist[start:stop] = mindist_b
+
+    return _centers_from_sums(X, centers, sums, counts, mindist)
+
+
+def fit(X, k, n_init=10, max_iter=20, tol=1e-6, seed=None,
+        backend="numpy"):
     """
     This function takes in unlabeled, scaled data and performs
     clustering using the KMeans clustering algorithm.
@@ -215,11 +639,40 @@ def fit(X, k):
     k : int
     The number of clusters to use for Kmeans.
 
+    n_init : int, optional
+    The number of times to run Kmeans from different initial centers. The
+    centers with the lowest sum of squared distances to their points are
+    returned. Default is 10.
+
+    max_iter : int, optional
+    The maximum number of iterations to run. Default is 20.
+
+    tol : float, optional
+    Stop once the total squared distance moved by the centers in an
+    iteration is below this value. Default is 1e-6.
+
+    seed : int or numpy.random.Generator, optional
+    Seed or random number generator used to initialize the centers, for
+    reproducible results.
+
+    backend : {"numpy", "cupy"}, optional
+    Where to run the Kmeans iterations. "cupy" runs them on the GPU, which
+    pays off for large data and requires cupy to be installed. Default is
+    "numpy".
+
     Returns
     -------
     array
     A (k,d) array of the center locations for each cluster.
 
+    Notes
+    -----
+    Distances are computed in single precision, which halves memory traffic
+    compared to double precision. Centers are means of many points, so this
+    has no practical effect on the clustering; the means themselves are
+    accumulated in double precision. The returned centers have the same
+    dtype as `X` if `X` is floating point, float64 otherwise.
+
     Examples
     --------
     >>> from sklearn.datasets import make_blobs
@@ -227,43 +680,251 @@ def fit(X, k):
     >>> centers = fit(X, 3)
 
     """
-    # Throw error if X contains missing values
-    if np.isnan(np.sum(X)):
-        raise Exception("Array contains non-numeric data")
-    # Throw error if X is not array-like
-    try:
-        pd.DataFrame(X)
-    except BaseException:
-        raise Exception("Data must be an array")
+    X = np.asarray(X)
+    dtype = _float_dtype(X.dtype)
+    X, X_mean = _check_data(X)
+    centers, _ = _fit(X, k, n_init, max_iter, tol, seed, backend)
+
+    return (centers + X_mean).astype(dtype, copy=False)
+
+
+def _fit(X, k, n_init, max_iter, tol, seed, backend, return_labels=False):
+    """
+    Does the work of `fit` on data already prepared by `_check_data`.
+
+    Returns the centers for the centered data and, if `return_labels` is
+    True, the cluster of every point, else None.
+    """
     #  Throw error if k is not an integer
     if isinstance(k, int) is not True:
         raise Exception("k must be an integer")
+    # Throw error if k > number of data points
+    if k > X.shape[0]:
+        raise Exception(
+            "Number of clusters must be less than number of data points")
+    # Throw error if k is negative
+    if k <= 0:
+        raise Exception("Number of clusters must be a positive integer")
+    #  Throw error if n_init is not a positive integer
+    if isinstance(n_init, int) is not True or n_init <= 0:
+        raise Exception("n_init must be a positive integer")
+    #  Throw error if backend is not supported
+    if backend not in ("numpy", "cupy"):
+        raise Exception("backend must be 'numpy' or 'cupy'")
+
+    rng = np.random.default_rng(seed)
+    # X does not change between runs or iterations, so neither do its norms
+    X_sq = np.einsum('ij,ij->i', X, X)
+    # data used for the iterations, which may live on the GPU
+    X_lloyd, X_sq_lloyd = X, X_sq
+    if backend == "cupy":
+        cp, _ = _import_cupy()
+        # upload X once, only the centers move between host and device
+        X_lloyd, X_sq_lloyd = cp.asarray(X), cp.asarray(X_sq)
+        lloyd = _lloyd_cupy
+    elif (_HAS_NUMBA and X.shape[1] < _NUMBA_MAX_DIM
+          and X.shape[0] * k <= _ELKAN_MAX_BOUNDS):
+        # the pruned kernel only beats the matrix product on narrow data
+        lloyd = _lloyd_elkan
+    else:
+        lloyd = _lloyd
+
+    def run(run_seed, parallel):
+        # initialize cluster centers
+        centers = init_centers(X, k, run_seed, X_sq)
+        return lloyd(X_lloyd, centers, X_sq_lloyd, max_iter, tol, parallel)
+
+    # each run gets its own seed so results do not depend on thread timing
+    seeds = rng.integers(np.iinfo(np.int64).max, size=n_init)
+    workers = min(n_init, os.cpu_count() or 1)
+    if lloyd is _lloyd_elkan:
+        # every run keeps its own bounds, stay within the budget in total
+        workers = min(workers, _ELKAN_MAX_BOUNDS // (X.shape[0] * k))
+    # only the compiled kernels release the GIL, the matrix products of the
+    # other paths already use every core through BLAS
+    threaded = lloyd is _lloyd_elkan or (
+        lloyd is _lloyd and _HAS_NUMBA and X.shape[1] < _NUMBA_MAX_DIM)
+    if threaded and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda run_seed: run(run_seed, False),
+                                    seeds))
+    else:
+        results = [run(run_seed, True) for run_seed in seeds]
+
+    # keep the centers with the lowest inertia
+    best_centers, _ = min(results, key=lambda result: result[1])
+
+    labels = None
+    if return_labels and backend == "cupy":
+        # assign on the device as well, X is already there
+        labels, _ = _assign_cupy(X_lloyd, cp.asarray(best_centers),
+                                 X_sq_lloyd)
+        labels = cp.asnumpy(labels)
+    elif return_labels:
+        labels, _ = _assign_fused(X, best_centers, X_sq)
+    return best_centers, labels
+
+
+def _lloyd(X, centers, X_sq, max_iter, tol, parallel=True):
+    """
+    Runs k-means iterations from `centers` until the total squared distance
+    moved by the centers drops below `tol` or `max_iter` is reached.
+    `parallel` controls whether compiled kernels may use multiple threads.
 
-    # initialize cluster centers and assign points to clusters
-    centers = init_centers(X, k)
-    i = 0    # iteration counter
+    Returns the final centers and their inertia, the sum of squared
+    distances from each point to its nearest center.
+    """
+    centers_T = np.empty((X.shape[1], centers.shape[0]), dtype=X.dtype)
+    # centers only change once per iteration, so compute their norms once
+    C_sq = np.einsum('ij,ij->i', centers, centers)
+
+    for i in range(max_iter):
+        # assign points to the closest center and recompute the centers
+        np.copyto(centers_T, centers.T)
+        new_centers = _iter(X, centers, X_sq, centers_T, C_sq, parallel)
+        C_sq = np.einsum('ij,ij->i', new_centers, new_centers)
+        # squared distance moved by the centers in this iteration
+        shift = np.sum((new_centers - centers)**2)
+        centers = new_centers
+        if shift < tol:
+            break
 
-    # first iteration
-    labels = assign(X, centers)  # assign cluster label based on closest center
-    new_centers = calc_centers(X, centers, labels)
-    new_labels = assign(X, centers)
+    return centers, _inertia(X, centers, X_sq, C_sq, parallel)
 
-    i += 1  # initialize iteration counter
 
-    # subsequent iterations
-    while((np.sum(new_centers - centers)) and (i < 20)):
+def _lloyd_elkan(X, centers, X_sq, max_iter, tol, parallel=True):
+    """
+    Same as `_lloyd`, but uses Elkan's algorithm to skip distance
+    computations that the triangle inequality shows cannot change a point's
+    cluster. Requires numba.
+    """
+    n = X.shape[0]
+    k = centers.shape[0]
+    labels = np.empty(n, dtype=np.intp)
+    upper = np.empty(n, dtype=X.dtype)
+    lower = np.empty((n, k), dtype=X.dtype)
+    if parallel:
+        elkan_init, elkan = _elkan_init_numba, _elkan_numba
+    else:
+        elkan_init, elkan = _elkan_init_numba_serial, _elkan_numba_serial
+    elkan_init(X, centers, labels, upper, lower)
+
+    C_sq = None
+    for i in range(max_iter):
+        # upper bounds on the distances stand in for the exact ones when
+        # choosing points for empty clusters
+        new_centers = calc_centers(X, centers, labels, upper**2)
+        C_sq = np.einsum('ij,ij->i', new_centers, new_centers)
+        # distance moved by each center in this iteration
+        moved = np.sqrt(np.sum((new_centers - centers)**2, axis=1))
         centers = new_centers
-        labels = new_labels
-        # assign cluster label based on closest center
-        new_labels = assign(X, centers)
-        new_centers = calc_centers(X, centers, new_labels)
+        # with a single center there is nothing to reassign
+        if np.sum(moved**2) < tol or k == 1:
+            break
 
-        i += 1
+        # moving the centers loosens the bounds by at most their movement
+        lower -= moved[None, :].astype(X.dtype)
+        np.maximum(lower, 0, out=lower)
+        upper += moved[labels].astype(X.dtype)
 
-    return new_centers
+        half_dist = 0.5 * measure_dist(centers, centers, C_sq, C_sq)
+        np.fill_diagonal(half_dist, np.inf)
+        s = half_dist.min(axis=1)
+        elkan(X, centers, half_dist, s, labels, upper, lower)
+
+    return centers, _inertia(X, centers, X_sq, C_sq, parallel)
+
+
+def _import_cupy():
+    """
+    Imports cupy and cupyx, which are only needed for the "cupy" backend.
+    """
+    try:
+        import cupy
+        import cupyx
+    except ImportError:
+        raise Exception("backend='cupy' requires cupy to be installed")
+    return cupy, cupyx
 
 
-def fit_assign(X, k):
+def _assign_cupy(X, centers, X_sq):
+    """
+    GPU version of `_assign_fused` for cupy arrays. Rows are processed in
+    blocks so the distance matrix fits in GPU memory for any `X`.
+    """
+    cp, _ = _import_cupy()
+    n = X.shape[0]
+    k = centers.shape[0]
+    block = max(1, _CUPY_BLOCK_SIZE // k)
+    C_sq = (centers * centers).sum(axis=1)
+
+    labels = cp.empty(n, dtype=cp.intp)
+    mindist = cp.empty(n, dtype=X.dtype)
+    for start in range(0, n, block):
+        stop = min(start + block, n)
+        D2 = X_sq[start:stop, None] + C_sq[None, :] \
+            - 2 * (X[start:stop] @ centers.T)
+        labels[start:stop] = D2.argmin(axis=1)
+        mindist[start:stop] = D2.min(axis=1)
+
+    # rounding can push distances of coincident points slightly below zero
+    cp.maximum(mindist, 0, out=mindist)
+    return labels, mindist
+
+
+def _lloyd_cupy(X, centers, X_sq, max_iter, tol, parallel=True):
+    """
+    Same as `_lloyd`, but runs on the GPU. `X` and `X_sq` are cupy arrays,
+    `centers` is copied to the device and the final centers are returned
+    as a numpy array. `parallel` is ignored.
+    """
+    cp, cupyx = _import_cupy()
+    n, d = X.shape
+    k = centers.shape[0]
+    # the double precision copy of a block of rows is (block, d)
+    block = max(1, _CUPY_BLOCK_SIZE // d)
+    centers = cp.asarray(centers, dtype=X.dtype)
+
+    for i in range(max_iter):
+        labels, mindist = _assign_cupy(X, centers, X_sq)
+
+        # sum and count the points assigned to each center, accumulating in
+        # double precision, one block at a time to bound the extra memory
+        counts = cp.bincount(labels, minlength=k)
+        sums = cp.zeros((k, d), dtype=cp.float64)
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            cupyx.scatter_add(sums, labels[start:stop],
+                              X[start:stop].astype(cp.float64))
+        new_centers = (sums / cp.maximum(counts, 1)[:, None]).astype(X.dtype)
+
+        # move centers with no points to the point farthest from any center
+        for kk in cp.asnumpy(cp.flatnonzero(counts == 0)):
+            farthest = int(mindist.argmax())
+            new_centers[kk] = X[farthest]
+            mindist[farthest] = 0
+
+        # squared distance moved by the centers in this iteration
+        shift = float(((new_centers - centers)**2).sum())
+        centers = new_centers
+        if shift < tol:
+            break
+
+    _, mindist = _assign_cupy(X, centers, X_sq)
+    return cp.asnumpy(centers), float(mindist.sum(dtype=cp.float64))
+
+
+def _inertia(X, centers, X_sq, C_sq=None, parallel=True):
+    """
+    Sum of squared distances from each point to its nearest center.
+    """
+    _, mindist = _assign_fused(X, centers, X_sq, C_sq=C_sq,
+                               parallel=parallel)
+    return mindist.sum(dtype=np.float64)
+
+
+def fit_assign(X, k, n_init=10, max_iter=20, tol=1e-6, seed=None,
+               backend="numpy"):
     """
     This function takes in data and performs clustering using the
     KMeans clustering algorithm.
@@ -276,6 +937,25 @@ def fit_assign(X, k):
     k : int
     The number of clusters to use for Kmeans.
 
+    n_init : int, optional
+    The number of times to run Kmeans from different initial centers, see
+    `fit`. Default is 10.
+
+    max_iter : int, optional
+    The maximum number of iterations to run. Default is 20.
+
+    tol : float, optional
+    Stop once the total squared distance moved by the centers in an
+    iteration is below this value. Default is 1e-6.
+
+    seed : int or numpy.random.Generator, optional
+    Seed or random number generator used to initialize the centers, for
+    reproducible results.
+
+    backend : {"numpy", "cupy"}, optional
+    Where to run the Kmeans iterations and the final assignment of points
+    to clusters, see `fit`. Default is "numpy".
+
     Returns
     -------
     array
@@ -284,25 +964,21 @@ def fit_assign(X, k):
     list
     A list containing the cluster label for every example (row) in X.
 
+    Notes
+    -----
+    Clustering is done in single precision, see `fit`. The returned centers
+    have the same dtype as `X` if `X` is floating point, float64 otherwise.
+
     Examples
     --------
     >>> from sklearn.datasets import make_blobs
     >>> X, _ = make_blobs(n_samples=10, centers=3, n_features=2)
     >>> centers, labels = fit_assign(X, 3)
     """
-    # Throw error if X contains missing values
-    if np.isnan(np.sum(X)):
-        raise Exception("Array contains non-numeric data")
-    # Throw error if X is not array-like
-    try:
-        pd.DataFrame(X)
-    except BaseException:
-        raise Exception("Input format not accepted")
-    #  Throw error if k is not an integer
-    if isinstance(k, int) is False:
-        raise Exception("k must be an integer")
-
-    centers = fit(X, k)
-    labels = assign(X, centers)
+    X = np.asarray(X)
+    dtype = _float_dtype(X.dtype)
+    X, X_mean = _check_data(X)
+    centers, labels = _fit(X, k, n_init, max_iter, tol, seed, backend,
+                           return_labels=True)
 
-    return centers, labels
+    return (centers + X_mean).astype(dtype, copy=False), labels
@@ -1,7 +1,9 @@
+from kmeaningful import fit_assign as fit_assign_module
 from kmeaningful.fit_assign import init_centers, assign, measure_dist, \
-    calc_centers, fit, fit_assign
+    measure_dist_sq, calc_centers, fit, fit_assign
 import numpy as np
 import pytest
+import types
 
 
 def test_init_centers():
@@ -25,6 +27,15 @@ def test_init_centers():
     # the centers have the same width as the data
     data = np.array([[0, 0, 0], [1, 1, 1]])
     assert init_centers(data, 2).shape[1] == data.shape[1]
+    # the same seed gives the same centers
+    data = np.random.rand(50, 2)
+    assert np.array_equal(init_centers(data, 5, seed=1),
+                          init_centers(data, 5, seed=1))
+    # more clusters than distinct points still gives k centers
+    data = np.array([[0, 0], [0, 0], [1, 1], [1, 1]])
+    centers = init_centers(data, 3)
+    assert centers.shape == (3, 2)
+    assert len(np.unique(centers, axis=0)) == 2
 
 
 def test_assign():
@@ -52,6 +63,28 @@ def test_assign():
     X = np.array([[5], [5]])
     centers = np.array([[0], [10]])
     assert np.array_equal(assign(X, centers), np.array([0, 0]))
+    # check that labels are correct when X spans several row blocks
+    X = np.random.rand(10000, 3)
+    centers = np.random.rand(5, 3)
+    expected = np.argmin(
+        ((X[:, None, :] - centers[None, :, :])**2).sum(axis=2), axis=1)
+    assert np.array_equal(assign(X, centers), expected)
+    # check that data far from the origin gets the labels of `fit_assign`
+    X = 1e4 + np.random.rand(3, 20)[np.arange(3000) % 3] \
+        + np.random.rand(3000, 20) / 10
+    X = X.astype(np.float32)
+    centers, labels = fit_assign(X, 3)
+    assert np.array_equal(assign(X, centers), labels)
+
+
+def test_assign_kernels(monkeypatch):
+    """Tests that the compiled and numpy assignment kernels agree"""
+    X = np.random.rand(500, 3)
+    centers = np.random.rand(7, 3)
+    labels = assign(X, centers)
+
+    monkeypatch.setattr(fit_assign_module, "_HAS_NUMBA", False)
+    assert np.array_equal(assign(X, centers), labels)
 
 
 def test_measure_dist():
@@ -79,6 +112,39 @@ def test_measure_dist():
     assert (measure_dist(X, centers) == np.array([[1], [2], [3]])).all()
 
 
+def test_measure_dist_sq():
+    """Tests that `measure_dist_sq` is working properly"""
+
+    # more centers than data points should throw an error
+    X = np.ones((10, 2))
+    centers = np.ones((11, 2))
+    with pytest.raises(Exception):
+        measure_dist_sq(X, centers)
+
+    # check that it calculates squared 2-d distance correctly
+    X = np.array([[0, 0]])
+    center = np.array([[3, 4]])
+    assert measure_dist_sq(X, center).item() == 25
+
+    # check that precomputed squared norms give the same result
+    X = np.array([[0, 1], [0, 2], [3, 3]])
+    centers = np.array([[0, 0], [1, 1]])
+    X_sq = (X**2).sum(axis=1)
+    C_sq = (centers**2).sum(axis=1)
+    assert np.array_equal(measure_dist_sq(X, centers, X_sq),
+                          measure_dist_sq(X, centers))
+    assert np.array_equal(measure_dist_sq(X, centers, X_sq, C_sq),
+                          measure_dist_sq(X, centers))
+
+    # check that it agrees with the squared euclidean distance for both
+    # small and large inputs
+    for n in [20, 100000]:
+        X = np.random.rand(n, 3)
+        centers = np.random.rand(4, 3)
+        expected = ((X[:, None, :] - centers[None, :, :])**2).sum(axis=2)
+        assert np.allclose(measure_dist_sq(X, centers), expected)
+
+
 def test_calc_centers():
     """Tests that `calc_centers` is working properly"""
     X = np.ones((10, 2))
@@ -93,6 +159,11 @@ def test_calc_centers():
     labels = np.ones(9)
     with pytest.raises(Exception):
         calc_centers(X, centers, labels)
+    # labels that do not match a center should throw an error
+    with pytest.raises(Exception):
+        calc_centers(X, centers, np.full(10, 2))
+    with pytest.raises(Exception):
+        calc_centers(X, centers, np.full(10, -1))
     # check one center is correctly calculated
     X = np.array([[-1, 0], [1, 0], [0, 1], [0, -1]])
     # this is used only to determine the number of centers
@@ -108,12 +179,19 @@ def test_calc_centers():
     assert np.array_equal(calc_centers(X, centers, labels),
                           np.array([[0, 0], [10, 0]]))
 
-    # check that if one center is the same as another center it gets moved
+    # check that centers with no points move to the points farthest from
+    # any center, without picking the same point twice
     X = np.array([[1, 0], [-1, 0], [9, 0], [11, 0], [19, 0], [21, 0]])
     centers = np.array([[0, 0], [100, 0.], [200, 0]])
     labels = np.array([0, 0, 0, 0, 0, 0])
-    new_centers = np.array([[10, 0], [-1, 0], [-1, 0]])
+    new_centers = np.array([[10, 0], [21, 0], [19, 0]])
     assert np.array_equal(calc_centers(X, centers, labels), new_centers)
+    # check that precomputed distances to the nearest center are used
+    mindist = np.array([1, 500, 81, 121, 361, 441])
+    new_centers = np.array([[10, 0], [-1, 0], [21, 0]])
+    assert np.array_equal(calc_centers(X, centers, labels, mindist),
+                          new_centers)
+    assert mindist[1] == 500
 
 
 def test_fit():
@@ -133,6 +211,20 @@ def test_fit():
     k = 1.5
     with pytest.raises(Exception):
         fit(X, k)
+    # should throw an error if X has values too large for single precision
+    with pytest.raises(Exception, match="too large"):
+        fit(np.array([[1e300], [0]]), 1)
+    # should throw an error if n_init is not a positive integer
+    with pytest.raises(Exception):
+        fit(X, 1, n_init=0)
+    # should throw an error if the backend is not supported
+    with pytest.raises(Exception):
+        fit(X, 1, backend="tensorflow")
+    # should throw an error if k is not positive or larger than n
+    with pytest.raises(Exception, match="positive"):
+        fit(X, 0)
+    with pytest.raises(Exception, match="less than"):
+        fit(np.empty((0, 2)), 1)
 
     # check that four points are correctly assigned to four clusters
     X = np.array([[0, 0], [0, 2], [10, 0], [10, 2]])
@@ -152,6 +244,89 @@ def test_fit():
     assert all([fit(X, 1)[i].tolist() in centers.tolist()
                 for i in range(centers.shape[0])])
 
+    # check that a single run finds the centers when there is one optimum
+    X = np.array([[0, 0], [0, 2], [10, 0], [10, 2]])
+    centers = np.array([[5, 1]])
+    assert np.array_equal(fit(X, 1, n_init=1), centers)
+
+    # check that floating point input keeps its dtype, other input is float64
+    assert fit(X, 2).dtype == np.float64
+    assert fit(X.astype(np.float32), 2).dtype == np.float32
+    assert fit(X.astype(np.float64), 2).dtype == np.float64
+
+    # duplicate rows with more clusters than distinct points
+    X = np.eye(3)[np.random.randint(0, 3, 50)]
+    assert fit(X, 5).shape == (5, 3)
+    assert fit([[0, 0], [0, 0], [1, 1], [1, 1]], 3).shape == (3, 2)
+
+
+def test_fit_kernels(monkeypatch):
+    """Tests that Elkan's algorithm and plain k-means find the same centers"""
+    X = np.random.rand(1000, 3)
+
+    centers = fit(X, 5, seed=123)
+
+    monkeypatch.setattr(fit_assign_module, "_HAS_NUMBA", False)
+    assert np.allclose(fit(X, 5, seed=123), centers, atol=1e-5)
+
+
+def test_fit_threads(monkeypatch):
+    """Tests that runs spread over threads give the same result"""
+    X = np.random.rand(1000, 3)
+
+    monkeypatch.setattr(fit_assign_module.os, "cpu_count", lambda: 1)
+    centers = fit(X, 5, seed=123)
+
+    monkeypatch.setattr(fit_assign_module.os, "cpu_count", lambda: 4)
+    assert np.array_equal(fit(X, 5, seed=123), centers)
+
+    # record the threads used instead of starting them
+    pools = []
+
+    class Pool(fit_assign_module.ThreadPoolExecutor):
+        def __init__(self, max_workers):
+            pools.append(max_workers)
+            super().__init__(max_workers=max_workers)
+
+    monkeypatch.setattr(fit_assign_module, "ThreadPoolExecutor", Pool)
+    # the distance bounds of all threads must fit in the budget
+    monkeypatch.setattr(fit_assign_module, "_ELKAN_MAX_BOUNDS", 2 * 1000 * 5)
+    fit(X, 5, seed=123)
+    assert pools == ([2] if fit_assign_module._HAS_NUMBA else [])
+    # no threads when the matrix product does the work
+    pools.clear()
+    monkeypatch.setattr(fit_assign_module, "_ELKAN_MAX_BOUNDS", 0)
+    fit(np.random.rand(1000, 20), 5, seed=123)
+    assert pools == []
+
+
+def test_fit_cupy(monkeypatch):
+    """Tests the "cupy" backend, with numpy standing in for cupy"""
+    cupy = types.ModuleType("cupy")
+    cupy.__dict__.update(np.__dict__)
+    cupy.asnumpy = np.asarray
+    cupyx = types.SimpleNamespace(scatter_add=np.add.at)
+    monkeypatch.setattr(fit_assign_module, "_import_cupy",
+                        lambda: (cupy, cupyx))
+    X = np.random.rand(1000, 3)
+
+    centers = fit(X, 5, seed=123, backend="cupy")
+    assert np.allclose(centers, fit(X, 5, seed=123))
+    centers, labels = fit_assign(X, 5, seed=123, backend="cupy")
+    assert np.array_equal(labels, assign(X, centers))
+
+    # the copies of X made to sum the clusters stay within the budget
+    sizes = []
+
+    def scatter_add(sums, labels, values):
+        sizes.append(values.size)
+        np.add.at(sums, labels, values)
+
+    cupyx.scatter_add = scatter_add
+    monkeypatch.setattr(fit_assign_module, "_CUPY_BLOCK_SIZE", 300)
+    fit(np.random.rand(1000, 30), 2, n_init=1, backend="cupy")
+    assert max(sizes) <= 300
+
 
 def test_fit_assign():
     """Tests that `fit_assign` is working properly"""
@@ -183,3 +358,23 @@ def test_fit_assign():
 
     # check that there are the correct number of disinct labels
     assert set(labels) == set(known_labels)
+
+    # data far from the origin still gets distinct centers
+    X = np.repeat(1e4 + np.random.rand(5, 3), 20, axis=0)
+    centers, _ = fit_assign(X.astype(np.float32), 5, n_init=1)
+    assert len(np.unique(centers, axis=0)) == 5
+
+    # the iteration settings are passed on to `fit`
+    X = np.random.rand(200, 2)
+    assert np.array_equal(fit_assign(X, 3, max_iter=1, tol=0, seed=1)[0],
+                          fit(X, 3, max_iter=1, tol=0, seed=1))
+
+    # double precision data far from the origin gets accurate centers
+    rng = np.random.default_rng(0)
+    known_centers = np.array([[0., 0.], [20., 20.]])
+    X = np.concatenate([rng.normal(center, 1, size=(500, 2))
+                        for center in known_centers])
+    centers, labels = fit_assign(X + 1e8, 2, seed=0)
+    expected = np.array([X[labels == i].mean(axis=0) for i in range(2)])
+    assert np.allclose(centers - 1e8, expected, atol=1e-3)
+    assert np.array_equal(np.bincount(labels), [500, 500])